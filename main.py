@@ -1,31 +1,65 @@
 #!/usr/bin/env python3
 
 import os
+import posixpath
 import subprocess
 import tempfile
+import io
+import tarfile
+import urllib.request
 import logging
 import re
 import yaml
+try:
+    from yaml import CSafeLoader as _YLoader
+except ImportError:
+    from yaml import SafeLoader as _YLoader
+try:
+    from yaml import CSafeDumper as _YDumper
+except ImportError:
+    from yaml import SafeDumper as _YDumper
 from slugify import slugify
 import argparse
+from functools import lru_cache, partial
+from concurrent.futures import ProcessPoolExecutor
 
 def lerp(x0, x1, /, t):
     return x0*(1-t) + x1*t
 
 def ensure_dir(path):
-    try:
-        os.makedirs(path)
-        logging.info(f"made dirs up to {path}")
-    except FileExistsError:
-        logging.info(f"using existing {path}")
+    os.makedirs(path, exist_ok=True)
+    logging.info(f"ensured {path}")
+
+_COMPOSE_NAMES = ("docker-compose.yaml", "docker-compose.yml")
+_COMPOSE_RE = re.compile(r"docker-compose\.ya?ml")
 
 def get_compose_file(dir):
-    for file in os.scandir(dir):
-        if file.is_file() and re.match("docker-compose\.ya?ml", file.name):
-            logging.info(f"found {file.path}")
-            return file
-    else:
-        return None
+    with os.scandir(dir) as it:
+        for file in it:
+            name = file.name
+            if (name in _COMPOSE_NAMES or _COMPOSE_RE.match(name)) and file.is_file(follow_symlinks=False):
+                logging.info(f"found {file.path}")
+                return file
+        else:
+            return None
+
+def load_services(stream):
+    loader = _YLoader(stream)
+    try:
+        # only construct python objects for the services section, skipping networks etc.
+        root = loader.get_single_node()
+        for key_node, value_node in root.value:
+            if key_node.value == 'services':
+                return loader.construct_document(value_node)
+        return {}
+    finally:
+        loader.dispose()
+
+_slugify = lru_cache(maxsize=1024)(slugify)
+
+@lru_cache(maxsize=1024)
+def _claim_name(pvc_name_template, name):
+    return pvc_name_template.format(name=name)
 
 def convert_service(name, service, pvc_name_template="{{{{ .Release.Name }}}}-{name}", ignore_volumes=[]):
     container = {}
@@ -36,35 +70,43 @@ def convert_service(name, service, pvc_name_template="{{{{ .Release.Name }}}}-{n
     container['image'] = service['image']
     if 'environment' in service:
         container['env'] = service['environment']
+    container['volumeMounts'] = []
     
     for vol_mount in service.get('volumes', []):
         # example: vol_mount = '/data/honeypots/log:/var/log/honeypots'
-        if 'volumeMounts' not in container:
-            container['volumeMounts'] = []
-        
-        host_path, guest_path = vol_mount.split(":")
-        pvc_name, pvc_path = host_path.removeprefix("/").split("/", 1)
-        pvc_name = slugify(pvc_name)
+        host_path, _, guest_path = vol_mount.partition(":")
+        guest_path, _, mode = guest_path.partition(":")
+        if not host_path.startswith("/") or not guest_path:
+            raise ValueError(f"unsupported volume mount {vol_mount!r} for {name}: expected '/host/path:/guest/path[:ro]'")
+        if mode not in ("", "rw", "ro"):
+            raise ValueError(f"unsupported mode {mode!r} in volume mount {vol_mount!r} for {name}")
+        pvc_name, _, pvc_path = host_path.removeprefix("/").partition("/")
+        if not pvc_name or not pvc_path:
+            raise ValueError(f"unsupported volume mount {vol_mount!r} for {name}: host path needs a volume and a subpath, like '/data/{name}'")
+        pvc_name = _slugify(pvc_name)
         vol_name = pvc_name
 
         volumes[vol_name] = {
             'name': vol_name,
             'persistentVolumeClaim': {
-                'claimName': pvc_name_template.format(name=pvc_name),
+                'claimName': _claim_name(pvc_name_template, pvc_name),
             }}
         
-        container['volumeMounts'].append({
+        volume_mount = {
             'name': vol_name,
             'subPath': pvc_path,
             'mountPath': guest_path,
-            })
+            }
+        if mode == "ro":
+            volume_mount['readOnly'] = True
+        container['volumeMounts'].append(volume_mount)
         
         if vol_name not in ignore_volumes:
             extras.append({
                 'apiVersion': "v1",
                 'kind': "PersistentVolumeClaim",
                 'metadata': {
-                    'name': pvc_name_template.format(name=pvc_name),
+                    'name': _claim_name(pvc_name_template, pvc_name),
                     'namespace': "{{ .Release.Namespace }}",
                     'labels' : {
                         'app': "{{ .Release.Namespace }}"
@@ -82,12 +124,9 @@ def convert_service(name, service, pvc_name_template="{{{{ .Release.Name }}}}-{n
     
     for tmpfs_mount in service.get('tmpfs', []):
         # example: tmpfs_mount = '/tmp/conpot:uid=2000,gid=2000'
-        if 'volumeMounts' not in container:
-            container['volumeMounts'] = []
-        
-        guest_path, attrs = tmpfs_mount.split(":")
-        attrs = dict(map(lambda a: a.split("="), attrs.split(",")))
-        vol_name = slugify(name + '-' + guest_path.removeprefix("/"))
+        guest_path, _, attrs = tmpfs_mount.partition(":")
+        attrs = {k: v for k, _, v in (a.partition("=") for a in attrs.split(","))}
+        vol_name = _slugify(name + '-' + guest_path.removeprefix("/"))
 
         securityContext = {}
         if 'uid' in attrs:
@@ -109,8 +148,98 @@ def convert_service(name, service, pvc_name_template="{{{{ .Release.Name }}}}-{n
             'mountPath': guest_path,
             })
     
+    if not container['volumeMounts']:
+        del container['volumeMounts']
+    
     return container, volumes, extras
  
+if hasattr(tarfile, 'data_filter'):
+    _TAR_EXTRACT_ARGS = {'filter': 'data'}
+else: # extraction filters need python 3.9.17/3.10.12/3.11.4+; the member name checks in fetch_tarball still keep files inside dest
+    _TAR_EXTRACT_ARGS = {}
+
+def github_tarball_url(repo, branch):
+    match = re.match(r"https://github\.com/([^/]+)/([^/]+?)(?:\.git)?/?$", repo)
+    if match:
+        owner, name = match.groups()
+        return f"https://codeload.github.com/{owner}/{name}/tar.gz/{branch}" # any ref, like git clone -b
+    else:
+        return None
+
+def fetch_tarball(url, path, dest):
+    path_parts = [part for part in path.split("/") if part not in ("", ".")]
+    extracted = 0
+    with urllib.request.urlopen(url) as resp, tarfile.open(fileobj=resp, mode="r|gz") as tar:
+        for member in tar:
+            # example: member.name = 'tpotce-master/docker/conpot/docker-compose.yml'
+            parts = member.name.split("/")
+            if not member.isfile() or len(parts) != len(path_parts) + 3 or parts[1:-2] != path_parts or parts[-2] in ("", ".", ".."):
+                continue
+            if not (parts[-1] in _COMPOSE_NAMES or _COMPOSE_RE.match(parts[-1])):
+                continue
+            member.name = "/".join(parts[1:]) # strip the '{repo}-{branch}/' prefix
+            logging.debug(f"extracting {member.name}")
+            tar.extract(member, dest, **_TAR_EXTRACT_ARGS)
+            extracted += 1
+    if not extracted:
+        raise FileNotFoundError(f"no compose files found under {path!r} in {url}")
+
+def git_checkout(repo, branch, path, dest, cache_repo):
+    if not os.path.isdir(cache_repo):
+        logging.info(f"mirroring {repo} into {cache_repo}")
+        subprocess.run(["git", "clone", "--bare", "--filter=blob:none", repo, cache_repo], check=True)
+    logging.info(f"updating {cache_repo} from {repo}:{branch}")
+    # fetch from repo itself into a ref of our own, since a bare clone has no remote.origin.fetch and would only update FETCH_HEAD
+    # no --depth: a shallow repo can't be used as a --reference
+    subprocess.run(["git", "-C", cache_repo, "fetch", "--no-tags", repo, f"+{branch}:refs/cache/{branch}"], check=True)
+
+    logging.info(f"cloning {repo}:{branch} into {dest}")
+    subprocess.run(["git", "clone", "--reference", cache_repo, "--branch", branch, "--depth", "1", "--single-branch", "--no-tags", "--filter=blob:none", "--sparse", repo, dest], check=True)
+    subprocess.run(["git", "-C", dest, "sparse-checkout", "set", path], check=True) # only check out the services we read
+
+_SOURCE_COMMENT = '{{{{/* derived from {src} */}}}}\n'
+_SERVICE_COMMENT = '{{{{/* container spec and volumes for {name} */}}}}\n'
+_DEFINE_HEADER = '{{{{- define "{name}.{suffix}" }}}}\n## Source: {src}\n'
+_DEFINE_FOOTER = '{{- end }}\n'
+
+def init_worker(log_level):
+    # workers started with spawn or forkserver don't inherit the parent's logging config
+    logging.basicConfig(level=log_level)
+
+def process_container(container_dir, out_dir, repo_url_guess, temp_dir, ignore_volumes=[]):
+    compose_file = get_compose_file(container_dir)
+    out_fname = f"_{container_dir.rpartition(os.sep)[2]}.tpl"
+    out_file = f"{out_dir}{os.sep}{out_fname}"
+
+    logging.debug(f"reading {compose_file.path}")
+    with open(compose_file, 'r') as stream:
+        services = load_services(stream)
+
+    buf = io.StringIO()
+    buf.write(_SOURCE_COMMENT.format(src=repo_url_guess + '/' + compose_file.path[len(temp_dir) + 1:])) # search_dir is normalized, so this is the relpath
+
+    for service_name, service in services.items():
+        service_name = _slugify(service_name)
+        container, volumes, extras = convert_service(service_name, service, ignore_volumes=ignore_volumes)
+
+        buf.write(_SERVICE_COMMENT.format(name=service_name))
+        buf.write(_DEFINE_HEADER.format(name=service_name, suffix="containers", src=out_fname))
+        yaml.dump([container], buf, Dumper=_YDumper, default_flow_style=False)
+        buf.write(_DEFINE_FOOTER)
+        buf.write(_DEFINE_HEADER.format(name=service_name, suffix="volumes", src=out_fname))
+        if volumes:
+            yaml.dump(list(volumes.values()), buf, Dumper=_YDumper, default_flow_style=False)
+        buf.write(_DEFINE_FOOTER)
+        buf.write(_DEFINE_HEADER.format(name=service_name, suffix="extras", src=out_fname))
+        yaml.dump_all(extras, buf, Dumper=_YDumper)
+        buf.write(_DEFINE_FOOTER)
+
+    logging.debug(f"writing {out_file}")
+    with open(out_file, 'w') as stream:
+        stream.write(buf.getvalue())
+
+    return out_fname
+
 def main():
     parser = argparse.ArgumentParser(description="Generate templates from tpot configurations.")
     parser.add_argument('-r', '--repo', type=str, help="Git repository URL to clone from.", default="https://github.com/telekom-security/tpotce.git")
@@ -118,25 +247,27 @@ def main():
     parser.add_argument('-p', '--path', type=str, help="Source path within git repo to search for services.", default="docker")
     parser.add_argument('-d', '--dest', type=str, help="Destination directory to write templates to.", default="./out")
     parser.add_argument('-x', '--exclude', action='extend', nargs='+', type=str, help="Don't generate based on these directories in the git repo; can specify multiple times.", default=[])
+    parser.add_argument('-c', '--cache', type=str, help="Directory to keep a local mirror of the git repo in, to speed up reruns; unused for GitHub repos, which are downloaded as a tarball.", default="./build/cache")
     parser.add_argument('-m', '--mount', action='extend', nargs='+', type=str, help="Don't create PVCs for these mounts; can specify multiple times.", default=[])
 
     parser.add_argument('-v', '--verbose', action='count', default=0)
 
     args = parser.parse_args()
 
-    logging.basicConfig(level=max(lerp(logging.WARN, logging.INFO, args.verbose), logging.DEBUG))
+    log_level = max(lerp(logging.WARN, logging.INFO, args.verbose), logging.DEBUG)
+    logging.basicConfig(level=log_level)
     logging.debug(f'{args}')
 
     if args.exclude:
-        exclude = parser.exclude
+        exclude = frozenset(args.exclude)
     else:
-        exclude = ['p0f', 'fatt', 'suricata', 'elk', 'ewsposter', 'nginx', 'spiderfoot', 'deprecated']
+        exclude = frozenset(['p0f', 'fatt', 'suricata', 'elk', 'ewsposter', 'nginx', 'spiderfoot', 'deprecated'])
         logging.info(f"defaulting {exclude=}")
     
     if args.mount:
-        mount = parser.mount
+        mount = frozenset(args.mount)
     else:
-        mount = ['data']
+        mount = frozenset(['data'])
         logging.info(f"defaulting {mount=}")
     
     out_dir = args.dest
@@ -145,70 +276,45 @@ def main():
     gitignore_file = os.path.join(out_dir, ".gitignore")
 
     src_repo = args.repo
+    src_path = posixpath.normpath(args.path).lstrip("/") or "."
+    if src_path == ".." or src_path.startswith("../"):
+        parser.error(f"--path {args.path!r} is outside the repo")
     src_branch = args.branch
     repo_url_guess = src_repo.removesuffix(".git") + "/tree/" + src_branch
     repo_name_guess = src_repo.removesuffix(".git").removesuffix("/").split("/")[-1]
 
-    with open(gitignore_file, 'w') as stream:
-        pass # truncate file to zero length
+    gitignore_lines = []
 
     with tempfile.TemporaryDirectory(prefix=repo_name_guess + "-") as temp_dir:
-        logging.info(f"cloning {src_repo}:{src_branch} into {temp_dir}")
-        subprocess.run(["git", "clone", "-b", src_branch, "--depth", "1", src_repo, temp_dir])
+        tarball_url = github_tarball_url(src_repo, src_branch)
+        if tarball_url:
+            logging.info(f"downloading {tarball_url} into {temp_dir}")
+            fetch_tarball(tarball_url, src_path, temp_dir)
+        else:
+            ensure_dir(args.cache)
+            cache_repo = os.path.join(args.cache, _slugify(src_repo) + ".git") # keyed on the full url, so forks don't share a mirror
+            git_checkout(src_repo, src_branch, src_path, temp_dir, cache_repo)
 
-        search_dir = os.path.join(temp_dir, args.path)
+        search_dir = os.path.normpath(os.path.join(temp_dir, src_path))
         
-        for container_dir in os.scandir(search_dir):
-            if not container_dir.is_dir() or container_dir.name in exclude:
-                logging.info(f"skipping {container_dir.path}")
-                continue
-            logging.info(f"scanning {container_dir.path}")
-
-            compose_file = get_compose_file(container_dir)
-            out_fname = "_" + container_dir.name + ".tpl"
-            out_file = os.path.join(out_dir, out_fname)
-
-            logging.debug(f"writing {out_file}")
-            with open(out_file, 'w') as stream: # insert source citation
-                stream.write('{{/* derived from ' + repo_url_guess + '/' + os.path.relpath(compose_file, temp_dir) + ' */}}\n')
-            
-            logging.debug(f"appending {gitignore_file}")
-            with open(gitignore_file, 'a') as stream: # add generated files to .gitignore
-                stream.writelines([out_fname, "\n"])
-
-            logging.debug(f"reading {compose_file.path}")
-            with open(compose_file, 'r') as stream:
-                contents = yaml.safe_load(stream)
-            
-            services = contents.get('services',{})
-
-            for service_name, service in services.items():
-                service_name = slugify(service_name)
-                container, volumes, extras = convert_service(service_name, service, ignore_volumes=mount)
-
-                with open(out_file, 'a') as stream:
-                    stream.writelines([
-                        '{{/* container spec and volumes for ' + service_name + ' */}}\n',
-                        '{{- define "' + service_name + '.containers" }}\n',
-                        f'## Source: {out_fname}\n',
-                    ])
-                    yaml.safe_dump([container], stream)
-                    stream.writelines([
-                        '{{- end }}\n',
-                        '{{- define "' + service_name + '.volumes" }}\n',
-                        f'## Source: {out_fname}\n',
-                    ])
-                    if volumes:
-                        yaml.safe_dump(list(volumes.values()), stream)
-                    stream.writelines([
-                        '{{- end }}\n',
-                        '{{- define "' + service_name + '.extras" }}\n',
-                        f'## Source: {out_fname}\n',
-                    ])
-                    yaml.safe_dump_all(extras, stream)
-                    stream.writelines([
-                        '{{- end }}\n',
-                    ])
+        container_dirs = []
+        with os.scandir(search_dir) as it:
+            for container_dir in it:
+                if not container_dir.is_dir(follow_symlinks=False) or container_dir.name in exclude:
+                    logging.info(f"skipping {container_dir.path}")
+                    continue
+                logging.info(f"scanning {container_dir.path}")
+                container_dirs.append(container_dir.path)
+
+        convert = partial(process_container, out_dir=out_dir, repo_url_guess=repo_url_guess, temp_dir=temp_dir, ignore_volumes=mount)
+        with ProcessPoolExecutor(initializer=init_worker, initargs=(log_level,)) as executor:
+            for out_fname in executor.map(convert, container_dirs):
+                gitignore_lines.extend([out_fname, "\n"]) # add generated files to .gitignore
+
+    logging.debug(f"writing {gitignore_file}")
+    with open(gitignore_file, 'w') as stream:
+        stream.writelines(gitignore_lines)
+
 if __name__ == "__main__":
     main()
 